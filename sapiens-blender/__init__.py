@@ -2,35 +2,79 @@ from __future__ import annotations
 
 import bpy
 import math
-import json
+import os
 from pathlib import Path
 import tomllib
-import re
+from contextlib import contextmanager
+
+# orjson isn't bundled with Blender, so fall back to the stdlib parser when it's missing
+try:
+    import orjson
+
+    def json_loads(data: bytes):
+        return orjson.loads(data)
+
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    import json
+
+    def json_loads(data: bytes):
+        return json.loads(data)
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+def resolve_export(blend_filepath):
+    """
+    Returns the export folder and file stem for a saved .blend as strings, or (None, None) if it isn't saved.
+    """
+    # Unsaved files have an empty filepath, and Path("") resolves to the working directory
+    if not blend_filepath:
+        return None, None
+
+    blend_path = Path(blend_filepath)
 
-def get_export_folder(blend_path):
-    blend_path = Path(bpy.data.filepath)
-    
     if not blend_path.exists():
-        return False
+        return None, None
         
     blend_dir = blend_path.parent
     export_dir = blend_dir.parent / "models" if blend_dir.name.lower() == "blends" else blend_dir
     export_dir.mkdir(parents=True, exist_ok=True)
-    return export_dir
+    return str(export_dir), blend_path.stem
+
+def deselect_all(context):
+    # Cheaper than bpy.ops.object.select_all, which goes through the operator system
+    for obj in context.view_layer.objects:
+        obj.select_set(False)
+
+@contextmanager
+def global_undo_disabled():
+    edit_prefs = bpy.context.preferences.edit
+    previous = edit_prefs.use_global_undo
+    edit_prefs.use_global_undo = False
+    try:
+        yield
+    finally:
+        edit_prefs.use_global_undo = previous
+
+def get_empties(context):
+    return [obj for obj in context.scene.objects if obj.type == 'EMPTY']
 
-def get_export_path(blend_path):
-    return get_export_folder(blend_path) / Path(blend_path).stem
+def get_extension_version() -> str:
+    return _EXTENSION_VERSION
 
-def get_material_file_path() -> Path:
-    blend_path = Path(bpy.data.filepath)
-    return blend_path.parent.parent / "hammerstone" / "shared" / "blender_materials.json"
-        
+_MANIFEST_PATH = Path(__file__).parent / "blender_manifest.toml"
 
-def get_extension_version() -> str:
-    config_path = Path(__file__).parent / "blender_manifest.toml"
-    with open(config_path, "rb") as config:
-        return tomllib.load(config).get("version", "Unknown")
-    return "Failed"
+def _read_extension_version() -> str:
+    try:
+        return tomllib.loads(_MANIFEST_PATH.read_text(encoding="utf-8")).get("version", "Unknown")
+    except (OSError, UnicodeDecodeError, tomllib.TOMLDecodeError):
+        return "Failed"
+
+# The manifest can't change without reloading the addon, so read it once
+# instead of on every panel redraw.
+_EXTENSION_VERSION = _read_extension_version()
 
 class SAPIENS_OT_export_parts(bpy.types.Operator):
     bl_idname = "sapiens.export_parts"
@@ -38,26 +82,19 @@ class SAPIENS_OT_export_parts(bpy.types.Operator):
     bl_description = "Exports every mesh in the model as its own GLTF file."
     
     def execute(self, context):
-        blend_path = Path(bpy.data.filepath)
-        if not blend_path.exists():
-            self.report({'ERROR'}, "File must be saved before exporting.")
-            return {'CANCELLED'}
-
-        export_root = get_export_folder(blend_path)
+        export_root, _ = resolve_export(bpy.data.filepath)
         if not export_root:
-            self.report({'ERROR'}, "Failed to resolve export folder.")
+            self.report({'ERROR'}, "File must be saved before exporting.")
             return {'CANCELLED'}
 
-        export_root.mkdir(parents=True, exist_ok=True)
-
         original_selection = context.selected_objects.copy()
         original_active = context.view_layer.objects.active
 
         exported_models = []
 
-        mesh_wrappers = MeshWrapper.get_sorted_wrappers()
+        mesh_wrappers = []
         any_errors_reported = False
-        for wrapper in mesh_wrappers:
+        for wrapper in MeshWrapper.get_sorted_wrappers():
             
             if not wrapper.export:
                 continue
@@ -67,42 +104,48 @@ class SAPIENS_OT_export_parts(bpy.types.Operator):
                 self.report({'WARNING'}, f"Mesh '{wrapper.object_name}' is invalid (missing _index?)")
                 continue
 
-            obj = wrapper.mesh
-            model_name = wrapper.mesh_name
-            if model_name in exported_models:
-                continue
-            
-            # Deselect all
-            bpy.ops.object.select_all(action='DESELECT')
+            mesh_wrappers.append(wrapper)
 
-            # Cache transforms
-            cached_matrix = obj.matrix_world.copy()
-            
-            # Select only the target mesh
-            obj.select_set(True)
-            context.view_layer.objects.active = obj
+        # Deselect all once; each mesh is deselected again after its export
+        deselect_all(context)
+
+        try:
+            with global_undo_disabled():
+                # Only the first mesh of each model is exported
+                for model_name, wrappers in MeshWrapper.group_by_mesh_name(mesh_wrappers).items():
+                    obj = wrappers[0].mesh
+
+                    # Cache transforms
+                    cached_matrix = obj.matrix_world.copy()
             
-            exported_models.append(model_name)
+                    # Select only the target mesh. The glTF exporter checks select_get() on each object,
+                    # so overriding selected_objects with context.temp_override isn't enough.
+                    obj.select_set(True)
+                    context.view_layer.objects.active = obj
             
-            obj.location = (0.0, 0.0, 0.0)
-            obj.rotation_euler = (0.0, 0.0, 0.0)
-            obj.scale = (1.0, 1.0, 1.0)
-
-            export_path = export_root / f"{model_name}.glb"
-            bpy.ops.export_scene.gltf(
-                filepath=str(export_path),
-                export_format='GLB',
-                use_selection=True,
-                export_apply=True,
-            )
+                    exported_models.append(model_name)
             
-            obj.matrix_world = cached_matrix
-
-        # Restore previous selection
-        bpy.ops.object.select_all(action='DESELECT')
-        for obj in original_selection:
-            obj.select_set(True)
-        context.view_layer.objects.active = original_active
+                    obj.location = (0.0, 0.0, 0.0)
+                    obj.rotation_euler = (0.0, 0.0, 0.0)
+                    obj.scale = (1.0, 1.0, 1.0)
+
+                    export_path = os.path.join(export_root, model_name + ".glb")
+                    try:
+                        bpy.ops.export_scene.gltf(
+                            filepath=export_path,
+                            export_format='GLB',
+                            use_selection=True,
+                            export_apply=True,
+                        )
+                    finally:
+                        obj.matrix_world = cached_matrix
+                        obj.select_set(False)
+        finally:
+            # Restore previous selection
+            deselect_all(context)
+            for obj in original_selection:
+                obj.select_set(True)
+            context.view_layer.objects.active = original_active
 
         if any_errors_reported:
             self.report({'WARNING'}, f"Exported {exported_models} to '{export_path}' with warnings (click to view)")
@@ -115,19 +158,19 @@ class SAPIENS_OT_add_buildables(bpy.types.Operator):
     bl_label = "Add Buildables"
     bl_description = "Adds the empties you need for a buildable."
     
+    BUILDABLE_EMPTIES = (
+        ("bounding_radius", 'SPHERE'),
+        ("placeAttach_box_1", 'CUBE'),
+        ("static_box", 'CUBE'),
+    )
+    
     def execute(self, context):
+        collection = context.collection
 
-        bounding_radius = bpy.data.objects.new("bounding_radius", None)
-        bounding_radius.empty_display_type = 'SPHERE'
-        bpy.context.collection.objects.link(bounding_radius)
-        
-        attach_box = bpy.data.objects.new("placeAttach_box_1", None)
-        attach_box.empty_display_type = 'CUBE'
-        bpy.context.collection.objects.link(attach_box)
-
-        static_box = bpy.data.objects.new("static_box", None)
-        static_box.empty_display_type = 'CUBE'
-        bpy.context.collection.objects.link(static_box)
+        for name, display_type in self.BUILDABLE_EMPTIES:
+            empty = bpy.data.objects.new(name, None)
+            empty.empty_display_type = display_type
+            collection.objects.link(empty)
 
         self.report({'INFO'}, "Done.")
         return {'FINISHED'}
@@ -157,9 +200,7 @@ class MeshWrapper():
 
         try:
             # Strip any . out (e.g., .0001)
-            working_name = self.object_name
-            if "." in working_name:
-                working_name = working_name.split(".")[0]
+            working_name = self.object_name.partition(".")[0]
 
             fields = working_name.split("_")
             self.mesh_name = fields[0]
@@ -180,6 +221,15 @@ class MeshWrapper():
 
         mesh_wrappers.sort()
         return mesh_wrappers
+
+    @staticmethod
+    def group_by_mesh_name(mesh_wrappers) -> dict[str, list[MeshWrapper]]:
+        groups = {}
+
+        for wrapper in mesh_wrappers:
+            groups.setdefault(wrapper.mesh_name, []).append(wrapper)
+
+        return groups
     
     def get_empty_name(self):
         return f"{self.resource_name}_{self.index}"
@@ -201,10 +251,11 @@ class MaterialFile():
         self.filepath = filepath
         self.ensure_file_exists()
         self.index = self.build_index()
+        # Whether the index has been written to since it was loaded
+        self.dirty = False
 
     def build_index(self):
-        with open(get_material_file_path(), "r") as f:
-            data = json.load(f)
+        data = json_loads(self.filepath.read_bytes())
 
         index = {}
         for material in data["hammerstone:global_definitions"]["hs_materials"]:
@@ -213,15 +264,11 @@ class MaterialFile():
 
     @staticmethod
     def get_default_data():
-        return json.loads(
-"""
-{
-    "hammerstone:global_definitions": {
-        "hs_materials": []
-    }
-}
-"""
-        )
+        return {
+            "hammerstone:global_definitions": {
+                "hs_materials": []
+            }
+        }
 
     def ensure_file_exists(self):
         if self.filepath.exists():
@@ -229,8 +276,7 @@ class MaterialFile():
         
         self.filepath.parent.mkdir(exist_ok=True, parents=True)
         
-        with open(self.filepath, "w") as f:
-            json.dump(MaterialFile.get_default_data(), f)
+        self.filepath.write_bytes(json_dumps(MaterialFile.get_default_data()))
 
     @staticmethod
     def get_default_path() -> Path:
@@ -242,45 +288,63 @@ class MaterialFile():
         return MaterialFile(MaterialFile.get_default_path())
     
     def save(self):
+        if not self.dirty:
+            return
+
         data = MaterialFile.get_default_data()
-        print(self.index.values())
 
         data["hammerstone:global_definitions"]["hs_materials"] = self.get_materials()
 
-        with open(self.filepath, "w") as f:
-            json.dump(data, f)
+        self.filepath.write_bytes(json_dumps(data))
+
+        self.dirty = False
     
     def get_materials(self):
-        materials = []
-        for material in self.index.values():
-            materials.append(material)
-        return materials
+        return list(self.index.values())
         
     def write_material(self, material):
-        self.index[material.name] = MaterialFile.material_to_json(material)
+        mat_data = MaterialFile.material_to_json(material)
+        if mat_data is None:
+            return
+
+        self.index[material.name] = mat_data
+        self.dirty = True
+
+    @staticmethod
+    def find_principled_bsdf(material):
+        if not (material.use_nodes and material.node_tree):
+            return None
+
+        nodes = material.node_tree.nodes
+
+        # Check the default node name first to avoid walking the whole tree
+        bsdf = nodes.get("Principled BSDF")
+        if bsdf and bsdf.bl_idname == 'ShaderNodeBsdfPrincipled':
+            return bsdf
+
+        return next((node for node in nodes if node.bl_idname == 'ShaderNodeBsdfPrincipled'), None)
 
     @staticmethod
     def material_to_json(material):
-        bsdf = None
-        if material and material.use_nodes:
-            for node in material.node_tree.nodes:
-                if node.type == 'BSDF_PRINCIPLED':
-                    bsdf = node
-                    break
+        if not material:
+            return None
 
+        bsdf = MaterialFile.find_principled_bsdf(material)
         if not bsdf:
             print(f"No Principled BSDF found in material {material.name}")
             return None
 
         # Extract values
-        color = bsdf.inputs['Base Color'].default_value[:3]  # RGB only
-        metal = bsdf.inputs['Metallic'].default_value
-        roughness = bsdf.inputs['Roughness'].default_value
+        # Principled BSDF socket layout since Blender 4.0: 0 Base Color, 1 Metallic, 2 Roughness
+        inputs = bsdf.inputs
+        color = tuple(inputs[0].default_value)[:3]  # RGB only
+        metal = inputs[1].default_value
+        roughness = inputs[2].default_value
 
         # Format data
         mat_data = {
             "identifier": material.name,
-            "color": [round(c, 3) for c in color],
+            "color": [round(color[0], 3), round(color[1], 3), round(color[2], 3)],
             "metal": round(metal, 3),
             "roughness": round(roughness, 3)
         }
@@ -359,29 +423,38 @@ class SAPIENS_OT_remove_duplicate_materials(bpy.types.Operator):
     bl_description = "Deletes any materials like 'bone.001' and replaces them with the proper material name (bone)."
 
     def execute(self, context):
-        suffix_pattern = re.compile(r"(.*)\.(\d{3})$")
         renamed_materials = {}
+        materials_by_name = {mat.name: mat for mat in bpy.data.materials}
+
+        # Index the mesh slots using each material, so duplicates don't rescan every object
+        slots_by_material = {}
+        for obj in bpy.data.objects:
+            if obj.type == 'MESH':
+                for slot in obj.material_slots:
+                    slots_by_material.setdefault(slot.material, []).append(slot)
 
         for mat in list(bpy.data.materials):  # Avoid modifying list during iteration
-            match = suffix_pattern.match(mat.name)
-            if match:
-                base_name = match.group(1)
-                base_mat = bpy.data.materials.get(base_name)
+            # Match names ending in a three digit suffix (e.g., bone.001)
+            base_name, dot, suffix = mat.name.rpartition(".")
+            if dot and len(suffix) == 3 and suffix.isdecimal():
+                base_mat = materials_by_name.get(base_name)
 
                 if base_mat:
                     # Replace users of the duplicate material
-                    for obj in bpy.data.objects:
-                        if obj.type == 'MESH':
-                            for slot in obj.material_slots:
-                                if slot.material == mat:
-                                    slot.material = base_mat
+                    slots = slots_by_material.pop(mat, [])
+                    for slot in slots:
+                        slot.material = base_mat
+                    slots_by_material.setdefault(base_mat, []).extend(slots)
                     renamed_materials[mat.name] = f"Replaced with '{base_name}' and removed"
                     
                     # Remove the duplicate material
+                    materials_by_name.pop(mat.name, None)
                     bpy.data.materials.remove(mat)
                 else:
-                    if not bpy.data.materials.get(base_name):
+                    if base_name not in materials_by_name:
+                        materials_by_name.pop(mat.name, None)
                         mat.name = base_name
+                        materials_by_name[mat.name] = mat
                         renamed_materials[mat.name] = "Renamed (no original existed)"
                     else:
                         renamed_materials[mat.name] = "Name conflict; not renamed"
@@ -395,9 +468,11 @@ class SAPIENS_OT_export_empties(bpy.types.Operator):
     bl_description = "Exports the scene with all meshes replaced by empties."
     
     def execute(self, context):
-        export_path = get_export_path(bpy.data.filepath)
-        if not export_path:
+        export_dir, export_name = resolve_export(bpy.data.filepath)
+        if not export_dir:
+            self.report({'ERROR'}, "File must be saved before exporting.")
             return {'CANCELLED'}
+        export_path = os.path.join(export_dir, export_name)
 
         # Track replacements and objects to export
         replacements = []
@@ -430,11 +505,11 @@ class SAPIENS_OT_export_empties(bpy.types.Operator):
             for collection in obj.users_collection:
                 collection.objects.link(empty)
 
-            replacements.append((obj, empty, original_name))
+            replacements.append((obj, original_name))
             new_empties.append(empty)
 
         # Deselect all
-        bpy.ops.object.select_all(action='DESELECT')
+        deselect_all(context)
 
         # Select only empties (new and existing) and cameras
         for obj in bpy.data.objects:
@@ -444,22 +519,20 @@ class SAPIENS_OT_export_empties(bpy.types.Operator):
         # Ensure an active object is set (some exporters need it)
         context.view_layer.objects.active = new_empties[0] if new_empties else None
 
-        bpy.ops.export_scene.gltf(
-            filepath=str(export_path),
-            export_format='GLB',
-            use_selection=True,
-            export_apply=True,
-            export_materials='PLACEHOLDER',
-            export_cameras=True
-        )
+        with global_undo_disabled():
+            bpy.ops.export_scene.gltf(
+                filepath=export_path,
+                export_format='GLB',
+                use_selection=True,
+                export_apply=True,
+                export_materials='PLACEHOLDER',
+                export_cameras=True
+            )
 
-        # Restore scene
-        for mesh_obj, empty, original_name in replacements:
-            # Remove the empty
-            for collection in empty.users_collection:
-                collection.objects.unlink(empty)
-            bpy.data.objects.remove(empty)
+        # Restore scene, removing all the empties in one go
+        bpy.data.batch_remove(ids=new_empties)
 
+        for mesh_obj, original_name in replacements:
             # Rename mesh back
             mesh_obj.name = original_name
 
@@ -476,11 +549,13 @@ class SAPIENS_OT_export(bpy.types.Operator):
     bl_description = "Exports the model."
     
     def execute(self, context):
-        export_path = get_export_path(bpy.data.filepath)
-        if not export_path:
+        export_dir, export_name = resolve_export(bpy.data.filepath)
+        if not export_dir:
+            self.report({'ERROR'}, "File must be saved before exporting.")
             return {'CANCELLED'}
+        export_path = os.path.join(export_dir, export_name)
 
-        bpy.ops.export_scene.gltf(filepath=str(export_path), export_format='GLB', use_selection=True)
+        bpy.ops.export_scene.gltf(filepath=export_path, export_format='GLB', use_selection=True)
 
         self.report({'INFO'}, f"Exported to {export_path}")
         return {'FINISHED'}
@@ -519,8 +594,8 @@ class SAPIENS_OT_scale_empties(bpy.types.Operator):
     bl_description = "Sets display scale of empties to 1."
     
     def execute(self, context):
-        for obj in context.scene.objects:
-            if obj.type == 'EMPTY':
+        for obj in get_empties(context):
+            if obj.empty_display_size != 1.0:
                 obj.empty_display_size = 1.0
         
         return {'FINISHED'}
@@ -531,9 +606,8 @@ class SAPIENS_OT_hide_empties(bpy.types.Operator):
     bl_description = "Hides all empties."
     
     def execute(self, context):
-        for obj in context.scene.objects:
-            if obj.type == 'EMPTY':
-                obj.hide_set(True)
+        for obj in get_empties(context):
+            obj.hide_set(True)
         
         return {'FINISHED'}
     
@@ -543,9 +617,8 @@ class SAPIENS_OT_show_empties(bpy.types.Operator):
     bl_description = "Shows all empties."
     
     def execute(self, context):
-        for obj in context.scene.objects:
-            if obj.type == 'EMPTY':
-                obj.hide_set(False)
+        for obj in get_empties(context):
+            obj.hide_set(False)
         
         return {'FINISHED'}
     
@@ -565,12 +638,11 @@ class SAPIENS_OT_set_empty_types(bpy.types.Operator):
         
         return obj.empty_display_type
         
-        
-        
     def execute(self, context):
-        for obj in context.scene.objects:
-            if obj.type == 'EMPTY':
-                obj.empty_display_type = self.get_empty_type(obj)
+        for obj in get_empties(context):
+            empty_type = self.get_empty_type(obj)
+            if obj.empty_display_type != empty_type:
+                obj.empty_display_type = empty_type
         
         return {'FINISHED'}
 